@@ -4,12 +4,12 @@ Secret Santa Generator
 ====================
 
 A robust implementation of a Secret Santa matching system with comprehensive validation,
-retry logic, and detailed debugging capabilities.
+constructive matching, and detailed debugging capabilities.
 
 Features:
 ---------
 - Input validation with detailed error reporting
-- Multiple matching strategies with intelligent retry logic
+- Single-pass family-aware matching (no retries needed)
 - Comprehensive debug logging
 - Family and category-based matching constraints
 - Progress indication and user-friendly output
@@ -37,16 +37,26 @@ Date: December 2024
 Version: 3.1
 """
 
+import atexit
+import csv
+import heapq
 import random
 import sys
+import tempfile
 import re
 import os
 from datetime import datetime
+from pathlib import Path
 import time
 import threading
-from collections import defaultdict
+import unittest
+from collections import Counter, defaultdict, namedtuple
+from itertools import islice
 from typing import Dict, List, Tuple, Optional
 
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\Z')
+Participant = namedtuple('Participant', ['firstName', 'lastName', 'family', 'category'])
+
 def ensureDirectories():
     """
     Ensures required directories exist: input, debug, and output.
@@ -75,44 +85,68 @@ def moveInputFileToFolder(inputFile):
     # If already in the input folder, return the path as is
     return inputFile
 
+class DebugLogger:
+    """
+    Appends timestamped messages to a debug file that stays open between calls.
+    Writes go through a 64 KiB buffer and reach the disk on close or when it fills.
+    The formatted timestamp is reused for every message logged within the same second.
+    """
+
+    def __init__(self, debugFile):
+        self.debugFile = debugFile
+        self.handle = None
+        self.lastSecond = None
+        self.lastTimestamp = ""
+
+    def timestamp(self):
+        second = int(time.time())
+        if second != self.lastSecond:
+            self.lastSecond = second
+            self.lastTimestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        return self.lastTimestamp
+
+    def log(self, messageType, message):
+        if self.handle is None:
+            self.handle = open(self.debugFile, 'a', buffering=1 << 16)
+        self.handle.write(f"[{self.timestamp()}] {messageType}: {message}\n")
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+debugLogger = DebugLogger("debug/allDebug.log")
+atexit.register(debugLogger.close)
+
 def writeDebugInfo(messageType, message):
     """
     Logs debugging information to a single debug file with a timestamp and message type.
     """
-    debugFile = "debug/allDebug.log"
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(debugFile, 'a') as dbg:
-        dbg.write(f"[{timestamp}] {messageType}: {message}\n")
+    debugLogger.log(messageType, message)
 
-def generateFileName(base, suffix):
+def generateFileName(base, suffix, timestamp):
     """
-    Generates a unique file name with a timestamp.
+    Generates a unique file name from the run timestamp.
     """
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     return f"{base}-{suffix}-{timestamp}.txt"
 
 def readInputFile(inputFilename):
     """
-    Reads the input file and returns a dictionary of participants with their details.
+    Reads the input file and returns a dictionary mapping each email to its Participant record.
     """
-    participants = {}
-    with open(inputFilename, 'r') as file:
-        for line in file:
-            email, firstName, lastName, family, category = line.strip().split(';')
-            participants[email] = {
-                'firstName': firstName,
-                'lastName': lastName,
-                'family': family,
-                'category': category
-            }
-    return participants
+    with open(inputFilename, 'r', encoding='utf-8-sig', newline='', buffering=1 << 20) as file:
+        return {
+            email: Participant(firstName, lastName, family, category)
+            for email, firstName, lastName, family, category in (
+                (field.strip() for field in row) for row in csv.reader(file, delimiter=';')
+            )
+        }
 
 def validateEmail(email):
     """
     Validates the email format using a regex pattern.
     """
-    pattern = r'^[a-zA-Z0-9.%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return EMAIL_PATTERN.match(email) is not None
 
 def validateInputData(participants):
     """
@@ -125,7 +159,7 @@ def validateInputData(participants):
         return False, "Need at least 2 participants."
 
     seenEmails = set()
-    categoryGroups = defaultdict(list)
+    categoryFamilyCounts = defaultdict(Counter)
 
     for email, details in participants.items():
         if not validateEmail(email):
@@ -137,101 +171,189 @@ def validateInputData(participants):
             return False, f"Duplicate email: {email}."
         seenEmails.add(email)
 
-        for field in ['firstName', 'lastName', 'family', 'category']:
-            if not details.get(field):
-                writeDebugInfo("ERROR", f"Missing field {field} for {email}.")
-                return False, f"Missing {field} for {email}."
+        if not all(details):
+            field = next(name for name, value in zip(Participant._fields, details) if not value)
+            writeDebugInfo("ERROR", f"Missing field {field} for {email}.")
+            return False, f"Missing {field} for {email}."
 
-        categoryGroups[details['category']].append(email)
+        categoryFamilyCounts[details.category][details.family] += 1
 
-    for category, members in categoryGroups.items():
-        if len(members) < 2:
+    for category, familySizes in categoryFamilyCounts.items():
+        categorySize = sum(familySizes.values())
+        if categorySize < 2:
             writeDebugInfo("ERROR", f"Category {category} has fewer than 2 participants.")
             return False, f"Category {category} has insufficient participants."
 
+        family, familySize = familySizes.most_common(1)[0]
+        if familySize * 2 > categorySize:
+            writeDebugInfo("ERROR", f"Family {family} holds {familySize} of {categorySize} participants in category {category}.")
+            return False, f"Family {family} makes up more than half of category {category}; no valid matching exists."
+
     writeDebugInfo("INFO", "Validation successful.")
     return True, "Validation passed."
 
-def matchParticipantsInCategory(participants, attempt):
+def swapPop(items, positions, item, *parallel):
     """
-    Matches participants in a single category while meeting constraints.
+    Removes item from a list in O(1) by moving the last element into its slot.
+    Lists in parallel hold per-item values and are kept aligned with items.
     """
-    writeDebugInfo("INFO", f"Attempting match, attempt {attempt}.")
-
-    emails = list(participants.keys())
+    index = positions.pop(item)
+    last = items.pop()
+    lastValues = [values.pop() for values in parallel]
+    if last != item:
+        items[index] = last
+        positions[last] = index
+        for values, lastValue in zip(parallel, lastValues):
+            values[index] = lastValue
+
+def matchParticipantsInCategory(families, rng):
+    """
+    Matches participants in a single category while meeting constraints.
 
-    if attempt % 3 == 0:
-        random.shuffle(emails)
-    elif attempt % 3 == 1:
-        emails.sort()
-    else:
-        emails.reverse()
+    Senders are taken in random order and each draws a random receiver from another
+    family. A family whose remaining senders plus receivers equal the number of
+    senders left must take part in the next match, which keeps a valid assignment
+    reachable at every step. A single pass therefore always succeeds when no family
+    holds more than half of the category. The largest family load is tracked in a
+    heap, and receivers are drawn from swap-pop pools, so the pass runs in
+    O(N log N). The lists in families are copied, not reordered.
+    """
+    groupSize = sum(len(members) for members in families.values())
+    writeDebugInfo("INFO", f"Attempting match for {groupSize} participants.")
+
+    maxFamilySize = max(len(members) for members in families.values())
+    if maxFamilySize * 2 > groupSize:
+        writeDebugInfo("ERROR", f"A family of {maxFamilySize} exceeds half of {groupSize} participants.")
+        return None
+
+    pool = []
+    poolFamilies = []
+    poolPositions = {}
+    buckets = {}
+    bucketPositions = {}
+    for family, members in families.items():
+        buckets[family] = list(members)
+        for index, email in enumerate(members):
+            bucketPositions[email] = index
+            poolPositions[email] = len(pool)
+            pool.append(email)
+            poolFamilies.append(family)
+
+    loads = {family: 2 * len(members) for family, members in families.items()}
+    loadHeap = [(-load, family) for family, load in loads.items()]
+    heapq.heapify(loadHeap)
+
+    senders = list(zip(pool, poolFamilies))
+    rng.shuffle(senders)
 
     matches = {}
-    receivers = set(emails)
-
-    for sender in emails:
-        validReceivers = [r for r in receivers if r != sender and participants[r]['family'] != participants[sender]['family']]
-        if not validReceivers:
-            writeDebugInfo("ERROR", f"No valid receiver for {sender}.")
-            return None
-
-        receiver = random.choice(validReceivers)
+    remaining = groupSize
+
+    for sender, senderFamily in senders:
+        # Entries are never updated in place; skip those left behind by later pushes
+        while loads.get(loadHeap[0][1]) != -loadHeap[0][0]:
+            heapq.heappop(loadHeap)
+        topLoad, topFamily = loadHeap[0]
+
+        if -topLoad == remaining and topFamily != senderFamily:
+            receiverFamily = topFamily
+            bucket = buckets[topFamily]
+            receiver = bucket[rng.randrange(len(bucket))]
+        else:
+            index = rng.randrange(remaining)
+            while poolFamilies[index] == senderFamily:
+                index = rng.randrange(remaining)
+            receiver = pool[index]
+            receiverFamily = poolFamilies[index]
+
+        swapPop(pool, poolPositions, receiver, poolFamilies)
+        swapPop(buckets[receiverFamily], bucketPositions, receiver)
         matches[sender] = receiver
-        receivers.remove(receiver)
+        remaining -= 1
+
+        for family in (senderFamily, receiverFamily):
+            loads[family] -= 1
+            if loads[family]:
+                heapq.heappush(loadHeap, (-loads[family], family))
+            else:
+                del loads[family]
+                del buckets[family]
 
     writeDebugInfo("INFO", "Matching successful.")
     return matches
 
-def matchSecretSanta(participants):
+def groupParticipants(participants):
     """
-    Performs the Secret Santa matching process with retries.
+    Groups participant emails by category and then by family.
     """
-    categories = defaultdict(dict)
+    categories = defaultdict(lambda: defaultdict(list))
     for email, details in participants.items():
-        categories[details['category']][email] = details
+        categories[details.category][details.family].append(email)
+    return categories
 
+def matchSecretSanta(categories, seed=None):
+    """
+    Performs the Secret Santa matching process for every category.
+    Passing a seed reproduces the same matches for the same input.
+    """
+    rng = random.Random(seed)
     finalMatches = {}
 
-    for category, group in categories.items():
-        for attempt in range(100):
-            matches = matchParticipantsInCategory(group, attempt)
-            if matches:
-                finalMatches.update(matches)
-                break
-        else:
-            writeDebugInfo("ERROR", f"Failed to match category {category} after 100 attempts.")
+    for category, families in categories.items():
+        matches = matchParticipantsInCategory(families, rng)
+        if not matches:
+            writeDebugInfo("ERROR", f"Failed to match category {category}.")
             return None
+        finalMatches.update(matches)
 
     return finalMatches
 
-def writeOutputFile(matches, participants, outputFile):
+def writeOutputFile(matches, participants, outputFile, chunkSize=1024):
     """
-    Writes the matches to an output file.
+    Writes the matches to an output file, chunkSize rows per write.
     """
-    with open(outputFile, 'w') as file:
-        for sender, receiver in matches.items():
-            senderDetails = participants[sender]
-            receiverDetails = participants[receiver]
-            file.write(
-                f"{senderDetails['firstName']},{senderDetails['lastName']},{sender},"
-                f"{receiverDetails['firstName']},{receiverDetails['lastName']},{receiver}\n"
-            )
+    lines = (
+        f"{participants[sender].firstName},{participants[sender].lastName},{sender},"
+        f"{participants[receiver].firstName},{participants[receiver].lastName},{receiver}\n"
+        for sender, receiver in matches.items()
+    )
 
-def showProgress():
+    with open(outputFile, 'w', buffering=1 << 20) as file:
+        while True:
+            chunk = "".join(islice(lines, chunkSize))
+            if not chunk:
+                break
+            file.write(chunk)
+
+def showProgress(stopEvent, delay=0.5):
     """
-    Displays a spinner to indicate progress.
+    Displays a spinner to indicate progress until stopEvent is set.
+    Nothing is drawn if the work finishes within the initial delay; after that the
+    label is written once and each tick only redraws the spinner character. The
+    spinner goes to stderr so it never mixes into redirected match output, and the
+    line is cleared again before returning.
     """
+    if stopEvent.wait(delay):
+        return
+
+    label = "Working...  "
+    sys.stderr.write(f"\r{label}")
     while True:
         for char in "|/-\\":
-            print(f"\rWorking... {char}", end="", flush=True)
-            time.sleep(0.1)
+            sys.stderr.write(f"\b{char}")
+            sys.stderr.flush()
+            if stopEvent.wait(0.25):
+                sys.stderr.write("\r" + " " * len(label) + "\r")
+                sys.stderr.flush()
+                return
 
 def main():
     """
     Main function to handle Secret Santa matching.
     """
+    progressThread = None
     try:
+        runTimestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         ensureDirectories()
 
         if len(sys.argv) > 1:
@@ -243,30 +365,43 @@ def main():
 
         writeDebugInfo("INFO", "Starting process.")
 
-        participants = readInputFile(inputFile)
+        try:
+            participants = readInputFile(inputFile)
+        except UnicodeDecodeError as error:
+            writeDebugInfo("ERROR", f"Input file {inputFile} is not valid UTF-8: {error}.")
+            print(f"Input file {inputFile} must be saved as UTF-8 (for example 'CSV UTF-8' in Excel).")
+            return False
 
         isValid, message = validateInputData(participants)
         if not isValid:
             print(message)
             return False
 
+        categories = groupParticipants(participants)
+
         while True:
-            progressThread = threading.Thread(target=showProgress, daemon=True)
+            stopProgress = threading.Event()
+            progressThread = threading.Thread(target=showProgress, args=(stopProgress,), daemon=True)
             progressThread.start()
 
-            matches = matchSecretSanta(participants)
+            matches = matchSecretSanta(categories)
+
+            stopProgress.set()
+            progressThread.join()
+            progressThread = None
 
             if matches:
-                print("\nProposed Matches:")
+                lines = ["\nProposed Matches:"]
                 for sender, receiver in matches.items():
                     senderDetails = participants[sender]
                     receiverDetails = participants[receiver]
-                    print(f"{senderDetails['firstName']} {senderDetails['lastName']} ({sender}) -> "
-                          f"{receiverDetails['firstName']} {receiverDetails['lastName']} ({receiver})")
+                    lines.append(f"{senderDetails.firstName} {senderDetails.lastName} ({sender}) -> "
+                                 f"{receiverDetails.firstName} {receiverDetails.lastName} ({receiver})")
+                sys.stdout.write("\n".join(lines) + "\n")
 
                 confirmation = input("\nAre these matches acceptable? (Y/N): ").strip().lower()
                 if confirmation in ('y', 'yes'):
-                    outputFile = f"output/{generateFileName(inputFile.rsplit('/', 1)[-1].rsplit('.', 1)[0], 'Matched')}"
+                    outputFile = f"output/{generateFileName(Path(inputFile).stem, 'Matched', runTimestamp)}"
                     writeOutputFile(matches, participants, outputFile)
                     print(f"\nResults saved to {outputFile}. Check debug/allDebug.log for details.")
                     return True
@@ -281,8 +416,93 @@ def main():
                 return False
 
     finally:
-        if 'progressThread' in locals():
+        debugLogger.close()
+        if progressThread is not None:
+            stopProgress.set()
             progressThread.join(0.2)
 
+class TestSecretSanta(unittest.TestCase):
+    """
+    Unit tests for the matcher, run with: python SecretSantaGenerator.py --test
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempDir = tempfile.TemporaryDirectory()
+        cls.originalDebugFile = debugLogger.debugFile
+        debugLogger.close()
+        debugLogger.debugFile = os.path.join(cls.tempDir.name, "allDebug.log")
+
+    @classmethod
+    def tearDownClass(cls):
+        debugLogger.close()
+        debugLogger.debugFile = cls.originalDebugFile
+        cls.tempDir.cleanup()
+
+    def assertValidMatches(self, participants, matches):
+        self.assertEqual(sorted(matches), sorted(participants))
+        self.assertEqual(sorted(matches.values()), sorted(participants))
+        for sender, receiver in matches.items():
+            self.assertNotEqual(participants[sender].family, participants[receiver].family)
+            self.assertEqual(participants[sender].category, participants[receiver].category)
+
+    def testMatchesRespectFamilyAndCategory(self):
+        participants = {
+            f"{name.lower()}@example.com": Participant(name, "Doe", family, category)
+            for name, family, category in [
+                ("Ann", "Family1", "Adults"), ("Ben", "Family1", "Adults"),
+                ("Cid", "Family2", "Adults"), ("Dee", "Family3", "Adults"),
+                ("Eve", "Family1", "Kids"), ("Fay", "Family2", "Kids"),
+            ]
+        }
+        self.assertValidMatches(participants, matchSecretSanta(groupParticipants(participants), seed=1))
+
+    def testFamilyHoldingHalfOfCategoryAlwaysMatches(self):
+        participants = {
+            f"{family}-{index}@example.com": Participant("Person", str(index), family, "Adults")
+            for family, size in [("Family1", 4), ("Family2", 2), ("Family3", 1), ("Family4", 1)]
+            for index in range(size)
+        }
+        categories = groupParticipants(participants)
+
+        for seed in range(200):
+            self.assertValidMatches(participants, matchSecretSanta(categories, seed))
+
+    def testCouplePartnersDoNotAlwaysGiveIntoSameFamily(self):
+        families = ["Family1", "Family2", "Family3", "Family4"]
+        participants = {
+            f"{family}-{partner}@example.com": Participant(partner, family, family, "Adults")
+            for family in families for partner in ("A", "B")
+        }
+        categories = groupParticipants(participants)
+
+        sameFamilyRuns = 0
+        for seed in range(200):
+            matches = matchSecretSanta(categories, seed)
+            sameFamilyRuns += all(
+                participants[matches[f"{family}-A@example.com"]].family
+                == participants[matches[f"{family}-B@example.com"]].family
+                for family in families
+            )
+
+        self.assertLess(sameFamilyRuns, 100)
+
+    def testMatchingScalesToLargeRosters(self):
+        participants = {
+            f"person{index}@example.com": Participant("Person", str(index), f"Family{index}", "Adults")
+            for index in range(10000)
+        }
+        categories = groupParticipants(participants)
+
+        start = time.perf_counter()
+        matches = matchSecretSanta(categories, seed=1)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(len(set(matches.values())), len(participants))
+        self.assertLess(elapsed, 1.0)
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "--test":
+        unittest.main(argv=sys.argv[:1])
+    else:
+        main()